@@ -21,7 +21,7 @@ setup(name='wgan',
       py_modules=['wgan'],
       install_requires=[
           "numpy",
-          "torch>=1.1.0",
+          "torch>=2.3.0",
           "tqdm",
           "tensorboardX>=1.8",
           "tensorboard>=2.0.0",
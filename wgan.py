@@ -10,7 +10,6 @@ TITLE
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils import data as D
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -18,6 +17,11 @@ from hypergrad import AdamHD
 from time import time
 
 
+def _to_tensor(df, cols):
+    # one float32 allocation, owned by the tensor (pandas may otherwise hand back a read-only view)
+    return torch.from_numpy(df[cols].to_numpy(dtype=np.float32, copy=True))
+
+
 class DataWrapper(object):
     """Class for processing raw training data for training Wasserstein GAN
 
@@ -49,6 +53,8 @@ class DataWrapper(object):
         List of float of standard deviation of continuous and context variables
     cat_dims: list
         List of dimension of each categorical variable
+    cat_categories: list
+        List of pandas.Index of the sorted levels of each categorical variable
     cat_labels: list
         List of labels of each categorical variable
     cont_bounds: torch.tensor
@@ -61,14 +67,16 @@ class DataWrapper(object):
                          categorical=categorical_vars,
                          context=context_vars)
         self.variables = variables
-        continuous, context = [torch.tensor(np.array(df[variables[_]])).to(torch.float) for _ in ("continuous", "context")]
+        continuous, context = [_to_tensor(df, variables[_]) for _ in ("continuous", "context")]
         self.means = [x.mean(0, keepdim=True) for x in (continuous, context)]
         self.stds  = [x.std(0,  keepdim=True) + 1e-5 for x in (continuous, context)]
+        (self._cont_mean, self._ctx_mean), (self._cont_std, self._ctx_std) = self.means, self.stds
         self.cat_dims = [df[v].nunique() for v in variables["categorical"]]
-        self.cat_labels = [torch.tensor(pd.get_dummies(df[v]).columns.to_numpy()).to(torch.float) for v in variables["categorical"]]
+        self.cat_categories = [pd.Index(df[v].dropna().unique()).sort_values() for v in variables["categorical"]]
+        self.cat_labels = [torch.tensor(c.to_numpy()).to(torch.float) for c in self.cat_categories]
         self.cont_bounds = [[continuous_lower_bounds[v] if v in continuous_lower_bounds.keys() else -1e8 for v in variables["continuous"]],
                             [continuous_upper_bounds[v] if v in continuous_upper_bounds.keys() else 1e8 for v in variables["continuous"]]]
-        self.cont_bounds = (torch.tensor(self.cont_bounds).to(torch.float) - self.means[0]) / self.stds[0]
+        self.cont_bounds = (torch.tensor(self.cont_bounds).to(torch.float) - self._cont_mean) / self._cont_std
 
     def preprocess(self, df):
         """
@@ -86,10 +94,13 @@ class DataWrapper(object):
         context: torch.tensor
             training data to be conditioned on by WGAN
         """
-        x, context = [torch.tensor(np.array(df[self.variables[_]])).to(torch.float) for _ in ("continuous", "context")]
-        x, context = [(x-m)/s for x,m,s in zip([x, context], self.means, self.stds)]
+        x, context = [_to_tensor(df, self.variables[_]) for _ in ("continuous", "context")]
+        x, context = (x - self._cont_mean) / self._cont_std, (context - self._ctx_mean) / self._ctx_std
         if len(self.variables["categorical"]) > 0:
-            categorical = torch.tensor(pd.get_dummies(df[self.variables["categorical"]], columns=self.variables["categorical"]).to_numpy())
+            codes = torch.stack([torch.as_tensor(c.get_indexer(df[v])) for c, v in zip(self.cat_categories, self.variables["categorical"])], -1)
+            if torch.any(codes < 0):
+                raise RuntimeError("It looks like there are NaNs or unseen categories in your categorical data. This is currently not supported!")
+            categorical = torch.cat([F.one_hot(c, d) for c, d in zip(codes.unbind(-1), self.cat_dims)], -1)
             x = torch.cat([x, categorical.to(torch.float)], -1)
         total = torch.cat([x, context], -1)
         if not torch.all(total==total):
@@ -111,12 +122,22 @@ class DataWrapper(object):
         df: pandas.DataFrame
             DataFrame with data converted back to original scale
         """
-        continuous, categorical = x.split((self.means[0].size(-1), sum(self.cat_dims)), -1)
-        continuous, context = [x*s+m for x,m,s in zip([continuous, context], self.means, self.stds)]
-        if categorical.size(-1) > 0:
-            categorical = torch.cat([l[torch.multinomial(p, 1)] for p, l in zip(categorical.split(self.cat_dims, -1), self.cat_labels)], -1)
-        df = pd.DataFrame(dict(zip(self.variables["continuous"] + self.variables["categorical"] + self.variables["context"],
-                                   torch.cat([continuous, categorical, context], -1).detach().t())))
+        continuous, categorical = x.split((self._cont_mean.size(-1), sum(self.cat_dims)), -1)
+        continuous, context = continuous * self._cont_std + self._cont_mean, context * self._ctx_std + self._ctx_mean
+        if categorical.size(-1) > 0: # one multinomial draw for all categorical variables
+            k, device = len(self.cat_dims), categorical.device
+            dims = torch.tensor(self.cat_dims, device=device)
+            group = torch.repeat_interleave(torch.arange(k, device=device), dims)
+            level = torch.arange(categorical.size(-1), device=device) - (dims.cumsum(0) - dims)[group]
+            # zero padding to (batch, variable, max level) keeps padded levels from being drawn
+            probs = categorical.new_zeros(categorical.size(0), k, max(self.cat_dims))
+            probs[:, group, level] = categorical
+            labels = probs.new_zeros(k, max(self.cat_dims))
+            labels[group, level] = torch.cat(self.cat_labels).to(device, probs.dtype)
+            idx = torch.multinomial(probs.view(-1, probs.size(-1)), 1).view(-1, k)
+            categorical = labels[torch.arange(k, device=device), idx]
+        df = pd.DataFrame(torch.cat([continuous, categorical, context], -1).detach().cpu().numpy(),
+                          columns=self.variables["continuous"] + self.variables["categorical"] + self.variables["context"])
         return df
 
     def apply_generator(self, generator, df):
@@ -190,6 +211,13 @@ class Specifications(object):
         Initial learning rate for critic
     critic_gp_factor: float
         Weight on gradient penalty for critic loss function
+    critic_gp_method: str
+        Either "autograd", which penalizes the exact input gradient norm via a
+        double backward, or "finite_difference", which penalizes a central
+        difference estimate of the directional derivative along a random unit
+        direction, with critic dropout disabled. The latter costs one extra critic
+        forward instead of a double backward, but only bounds the gradient norm
+        from below.
     generator_d_hidden: list
         List of int, length equal to the number of hidden layers in generator,
         giving the size of each hidden layer.
@@ -220,6 +248,14 @@ class Specifications(object):
         weights during training.
     print_every: int
         How often to print training status during training.
+    compile_models: bool
+        Whether to wrap the generator, critic and gradient penalty with
+        torch.compile during training, fusing the elementwise ops of each layer.
+        Adds a one-off compilation cost at the start of training.
+    mixed_precision: str
+        If "bfloat16" or "float16", runs the generator and critic forwards in that
+        precision via torch.autocast. The gradient penalty stays in float32, and
+        float16 losses are scaled with a GradScaler. None trains in float32.
     device: str
         Either "cuda" if GPU is available or "cpu" if not
 
@@ -238,6 +274,7 @@ class Specifications(object):
                  critic_steps = 15,
                  critic_lr = 1e-4,
                  critic_gp_factor = 5,
+                 critic_gp_method = "autograd",
                  generator_d_hidden = [128,128,128],
                  generator_dropout = 0.1,
                  generator_lr = 1e-4,
@@ -251,6 +288,8 @@ class Specifications(object):
                  save_checkpoint = None,
                  save_every = 100,
                  print_every = 200,
+                 compile_models = False,
+                 mixed_precision = None,
                  device = "cuda" if torch.cuda.is_available() else "cpu"):
 
         self.settings = locals()
@@ -268,6 +307,26 @@ class Specifications(object):
         print("settings:", self.settings)
 
 
+def _penalty(gradients):
+    return F.relu(gradients.norm(2, dim=1) - 1).mean()             # one-sided
+    # return (gradients.norm(2, dim=1) - 1).pow(2).mean()          # two-sided
+
+
+def _mlp(d_in, d_out, dropout):
+    # dense network as one static graph of Linear -> ReLU -> Dropout blocks and a Linear output layer
+    hidden = [nn.Sequential(nn.Linear(i, o), nn.ReLU(inplace=True), nn.Dropout(dropout)) for i, o in zip(d_in[:-1], d_out[:-1])]
+    return nn.Sequential(*hidden, nn.Linear(d_in[-1], d_out[-1]))
+
+
+def _load_flat_layers(module, state_dict, prefix, *args):
+    # maps state dicts saved with a flat list of Linear layers ("layers.i.weight") onto the blocks of _mlp
+    for i in range(len(module.layers) - 1):
+        for name in ("weight", "bias"):
+            key = "{}layers.{}.{}".format(prefix, i, name)
+            if key in state_dict:
+                state_dict["{}layers.{}.0.{}".format(prefix, i, name)] = state_dict.pop(key)
+
+
 class Generator(nn.Module):
     """
     torch.nn.Module class for generator network in WGAN
@@ -288,38 +347,41 @@ class Generator(nn.Module):
         Total dimension of continuous variables
     d_cat: int
         Total dimension of categorical variables
+    uniform_cat_dims: bool
+        Whether all categorical variables have the same dimension
     d_noise: int
         Dimension of noise input to generator
-    layers: torch.nn.ModuleList
-        Dense neural network layers making up the generator
-    dropout: torch.nn.Dropout
-        Dropout layer based on specifications
+    layers: torch.nn.Sequential
+        Dense neural network layers making up the generator, with dropout
+        based on specifications
     ATTRIBUTES
     """
     def __init__(self, specifications):
         super().__init__()
         s, d = specifications.settings, specifications.data
-        self.cont_bounds = d["cont_bounds"]
+        self.register_buffer("cont_bounds", d["cont_bounds"], persistent=False)
         self.cat_dims = d["cat_dims"]
         self.d_cont = self.cont_bounds.size(-1)
         self.d_cat = sum(d["cat_dims"])
+        self.uniform_cat_dims = len(set(self.cat_dims)) == 1
         self.d_noise = s["generator_d_noise"]
         d_in = [self.d_noise + d["d_context"]] + s["generator_d_hidden"]
         d_out = s["generator_d_hidden"] + [self.d_cont + self.d_cat]
-        self.layers = nn.ModuleList([nn.Linear(i, o) for i, o in zip(d_in, d_out)])
-        self.dropout = nn.Dropout(s["generator_dropout"])
+        self.layers = _mlp(d_in, d_out, s["generator_dropout"])
+        self._register_load_state_dict_pre_hook(_load_flat_layers, with_module=True)
 
     def _transform(self, hidden):
         continuous, categorical = hidden.split([self.d_cont, self.d_cat], -1)
         if continuous.size(-1) > 0: # apply bounds to continuous
-            bounds = self.cont_bounds.to(hidden.device)
-            continuous = torch.stack([continuous, bounds[0:1].expand_as(continuous)]).max(0).values
-            continuous = torch.stack([continuous, bounds[1:2].expand_as(continuous)]).min(0).values
+            continuous = continuous.clamp(self.cont_bounds[0:1], self.cont_bounds[1:2])
         if categorical.size(-1) > 0: # renormalize categorical
-            categorical = torch.cat([F.softmax(x, -1) for x in categorical.split(self.cat_dims, -1)], -1)
+            if self.uniform_cat_dims: # one softmax over (batch, variable, category)
+                categorical = F.softmax(categorical.reshape(-1, len(self.cat_dims), self.cat_dims[0]), -1).reshape(categorical.shape)
+            else:
+                categorical = torch.cat([F.softmax(x, -1) for x in categorical.split(self.cat_dims, -1)], -1)
         return torch.cat([continuous, categorical], -1)
 
-    def forward(self, context):
+    def forward(self, context, noise=None):
         """
             Run generator model
 
@@ -327,16 +389,17 @@ class Generator(nn.Module):
         ----------
         context: torch.tensor
             Variables to condition on
+        noise: torch.tensor
+            Optional pregenerated standard normal noise of size
+            (context.size(0), d_noise), drawn fresh if None
 
         Returns
         -------
         torch.tensor
         """
-        noise = torch.randn(context.size(0), self.d_noise).to(context.device)
-        x = torch.cat([noise, context], -1)
-        for layer in self.layers[:-1]:
-            x = self.dropout(F.relu(layer(x)))
-        return self._transform(self.layers[-1](x))
+        if noise is None:
+            noise = torch.randn(context.size(0), self.d_noise, device=context.device)
+        return self._transform(self.layers(torch.cat([noise, context], -1)))
 
 
 class Critic(nn.Module):
@@ -350,10 +413,11 @@ class Critic(nn.Module):
     ATTRIBUTES
     Attributes
     ----------
-    layers: torch.nn.ModuleList
-        Dense neural network making up the critic
-    dropout: torch.nn.Dropout
-        Dropout layer applied between each of hidden layers
+    layers: torch.nn.Sequential
+        Dense neural network making up the critic, with dropout applied
+        between each of hidden layers
+    gp_method: str
+        How input gradients for the gradient penalty are computed
     ATTRIBUTES
     """
     def __init__(self, specifications):
@@ -361,8 +425,11 @@ class Critic(nn.Module):
         s, d = specifications.settings, specifications.data
         d_in = [d["d_x"] + d["d_context"]] + s["critic_d_hidden"]
         d_out = s["critic_d_hidden"] + [1]
-        self.layers = nn.ModuleList([nn.Linear(i, o) for i, o in zip(d_in, d_out)])
-        self.dropout = nn.Dropout(s["critic_dropout"])
+        self.layers = _mlp(d_in, d_out, s["critic_dropout"])
+        self._register_load_state_dict_pre_hook(_load_flat_layers, with_module=True)
+        self.gp_method = s["critic_gp_method"]
+        if self.gp_method not in ("autograd", "finite_difference"):
+            raise RuntimeError("critic_gp_method must be either autograd or finite_difference.")
 
     def forward(self, x, context):
         """
@@ -379,12 +446,9 @@ class Critic(nn.Module):
         -------
         torch.tensor
         """
-        x = torch.cat([x, context], -1)
-        for layer in self.layers[:-1]:
-            x = self.dropout(F.relu(layer(x)))
-        return self.layers[-1](x)
+        return self.layers(torch.cat([x, context], -1))
 
-    def gradient_penalty(self, x, x_hat, context):
+    def gradient_penalty(self, x, x_hat, context, eps=1e-2, penalty=_penalty):
         """
         Calculate gradient penalty
 
@@ -396,20 +460,32 @@ class Critic(nn.Module):
             generated data
         context: torch.tensor
             context data
+        eps: float
+            step size of the finite difference, if used
+        penalty: function
+            maps input gradients to the gradient penalty
 
         Returns
         -------
         torch.tensor
         """
-        alpha = torch.rand(x.size(0)).unsqueeze(1).to(x.device)
-        interpolated = x * alpha + x_hat * (1 - alpha)
-        interpolated = torch.autograd.Variable(interpolated.detach(), requires_grad=True)
-        critic = self(interpolated, context)
-        gradients = torch.autograd.grad(critic, interpolated, torch.ones_like(critic),
-                                        retain_graph=True, create_graph=True, only_inputs=True)[0]
-        penalty = F.relu(gradients.norm(2, dim=1) - 1).mean()             # one-sided
-        # penalty = (gradients.norm(2, dim=1) - 1).pow(2).mean()          # two-sided
-        return penalty
+        alpha = torch.rand(x.size(0), 1, device=x.device)
+        interpolated = torch.lerp(x_hat.detach().to(x.dtype), x, alpha) # x * alpha + x_hat * (1 - alpha)
+        if self.gp_method == "finite_difference": # central difference along a random unit direction
+            u = F.normalize(torch.randn_like(interpolated), dim=1)
+            training = self.training
+            self.train(False) # both perturbed points need the same dropout mask, so dropout is off here
+            try:
+                critic = self(torch.cat([interpolated + eps * u, interpolated - eps * u]), context.repeat(2, 1))
+            finally:
+                self.train(training)
+            gradients = (critic[:x.size(0)] - critic[x.size(0):]) / (2 * eps)
+        else:
+            interpolated.requires_grad_(True)
+            critic = self(interpolated, context)
+            gradients = torch.autograd.grad(critic, interpolated, torch.ones_like(critic),
+                                            retain_graph=True, create_graph=True, only_inputs=True)[0]
+        return penalty(gradients)
 
     def gaussian_similarity(self, x_hat, context, eps=1e-4):
         """
@@ -434,6 +510,15 @@ class Critic(nn.Module):
         return loglik
 
 
+def _batches(tensors, batch_size, shuffle=False, drop_last=False):
+    # yields minibatches by indexing into tensors that already live on the training device
+    n, device = tensors[0].size(0), tensors[0].device
+    idx = torch.randperm(n, device=device) if shuffle else torch.arange(n, device=device)
+    for i in idx.split(batch_size):
+        if drop_last and i.size(0) < batch_size: break
+        yield [v[i] for v in tensors]
+
+
 def train(generator, critic, x, context, specifications):
     """
     Function for training generator and critic in conditional WGAN-GP
@@ -457,11 +542,44 @@ def train(generator, critic, x, context, specifications):
     s = specifications.settings
     start_epoch, step, description, device, t = 0, 1, "", s["device"], time()
     generator.to(device), critic.to(device)
+    G, C = generator, critic
+    if s["compile_models"]: # gradient penalty needs double backward, so it keeps using the eager critic
+        G, C = (torch.compile(m, mode="reduce-overhead", dynamic=False) for m in (generator, critic))
+    penalty = torch.compile(_penalty, dynamic=False) if s["compile_models"] else _penalty
+    if s["mixed_precision"] not in (None, "bfloat16", "float16"):
+        raise RuntimeError("mixed_precision must be either None, bfloat16 or float16.")
     opt = {"AdamHD": AdamHD, "Adam": torch.optim.Adam}[s["optimizer"]]
-    opt_generator = opt(generator.parameters(), lr=s["generator_lr"])
-    opt_critic = opt(critic.parameters(), lr=s["critic_lr"])
-    train_batches, test_batches = D.random_split(D.TensorDataset(x, context), (x.size(0)-s["test_set_size"], s["test_set_size"]))
-    train_batches, test_batches = (D.DataLoader(d, s["batch_size"], shuffle=True) for d in (train_batches, test_batches))
+    # fused Adam updates all parameters of a network in a single kernel on CUDA
+    fused = dict(fused=True) if s["optimizer"] == "Adam" and torch.device(device).type == "cuda" else {}
+    opt_generator = opt(generator.parameters(), lr=s["generator_lr"], **fused)
+    opt_critic = opt(critic.parameters(), lr=s["critic_lr"], **fused)
+    autocast = dict(device_type=torch.device(device).type, enabled=s["mixed_precision"] is not None,
+                    dtype=getattr(torch, s["mixed_precision"] or "float32"))
+    scaler = torch.amp.GradScaler(autocast["device_type"], enabled=s["mixed_precision"] == "float16")
+    x, context = x.to(device), context.to(device) # the data is small enough to keep on the device
+    split = (x.size(0)-s["test_set_size"], s["test_set_size"])
+    perm = torch.randperm(x.size(0), device=device)
+    (x_train, x_test), (context_train, context_test) = (v[perm].split(split) for v in (x, context))
+    drop_last = s["compile_models"] # partial batches would change the compiled shapes
+    if drop_last and x_train.size(0) < s["batch_size"]:
+        raise RuntimeError("compile_models needs a training set of at least batch_size observations.")
+
+    def critic_step(x, context, noise):
+        opt_critic.zero_grad(set_to_none=True) # also clears critic grads left over from the generator step
+        with torch.autocast(**autocast):
+            with torch.no_grad(): # no generator graph needed
+                x_hat = G(context, noise)
+            # real and generated data go through the critic as one batch
+            critic_x, critic_x_hat = C(torch.cat([x, x_hat]), context.repeat(2, 1)).split(x.size(0))
+        WD = critic_x.mean() - critic_x_hat.mean()
+        loss = - WD
+        loss += s["critic_gp_factor"] * critic.gradient_penalty(x, x_hat, context, penalty=penalty) # kept in full precision
+        if s["gaussian_similarity_penalty"] is not None:
+            loss += s["gaussian_similarity_penalty"] * critic.gaussian_similarity(x_hat, context)
+        scaler.scale(loss).backward()
+        scaler.step(opt_critic)
+        scaler.update()
+        return WD.detach()
 
     # load checkpoints
     if s["load_checkpoint"]:
@@ -475,44 +593,30 @@ def train(generator, critic, x, context, specifications):
     for epoch in range(start_epoch, s["max_epochs"]):
         # train loop
         WD_train, n_batches = 0, 0
-        for x, context in train_batches:
-            x, context = x.to(device), context.to(device)
+        noise = torch.randn(x_train.size(0), generator.d_noise, device=device) # one draw for the whole epoch
+        for x, context, noise_batch in _batches((x_train, context_train, noise), s["batch_size"], shuffle=True, drop_last=drop_last):
             generator_update = step % s["critic_steps"] == 0
-            for par in critic.parameters():
-                par.requires_grad = not generator_update
-            for par in generator.parameters():
-                par.requires_grad = generator_update
-            if generator_update:
-                generator.zero_grad()
+            if not generator_update:
+                WD = critic_step(x, context, noise_batch)
             else:
-                critic.zero_grad()
-            x_hat = generator(context)
-            critic_x_hat = critic(x_hat, context).mean()
+                opt_generator.zero_grad(set_to_none=True)
+                with torch.autocast(**autocast):
+                    loss = - C(G(context, noise_batch), context).mean()
+                scaler.scale(loss).backward()
+                scaler.step(opt_generator)
+                scaler.update()
             if not generator_update:
-                critic_x = critic(x, context).mean()
-                WD = critic_x - critic_x_hat
-                loss = - WD
-                loss += s["critic_gp_factor"] * critic.gradient_penalty(x, x_hat, context)
-                if s["gaussian_similarity_penalty"] is not None:
-                    loss += s["gaussian_similarity_penalty"] * critic.gaussian_similarity(x_hat, context)
-                loss.backward()
-                opt_critic.step()
                 WD_train += WD.item()
                 n_batches += 1
-            else:
-                loss = - critic_x_hat
-                loss.backward()
-                opt_generator.step()
             step += 1
         WD_train /= n_batches
         # test loop
         WD_test, n_batches = 0, 0
-        for x, context in test_batches:
-            x, context = x.to(device), context.to(device)
-            with torch.no_grad():
-                x_hat = generator(context)
-                critic_x_hat = critic(x_hat, context).mean()
-                critic_x = critic(x, context).mean()
+        for x, context in _batches((x_test, context_test), s["batch_size"]):
+            with torch.no_grad(), torch.autocast(**autocast):
+                x_hat = G(context)
+                critic_x_hat = C(x_hat, context).mean()
+                critic_x = C(x, context).mean()
                 WD_test += (critic_x - critic_x_hat).item()
                 n_batches += 1
         WD_test /= n_batches
@@ -605,16 +709,20 @@ def compare_dfs(df_real, df_fake, scatterplot=dict(x=[], y=[], samples=400, smoo
             fig2.show()
     # scatterplot grid
     if scatterplot and len(scatterplot["x"]) * len(scatterplot["y"]) > 0:
+        x_vars, y_vars = scatterplot["x"], scatterplot["y"]
+        plot_vars = list(dict.fromkeys([*x_vars, *y_vars]))
         df_real_sample = df_real.sample(scatterplot["samples"])
         df_fake_sample = df_fake.sample(scatterplot["samples"])
-        x_vars, y_vars = scatterplot["x"], scatterplot["y"]
+        # column by column, so each keeps its own dtype
+        real = {c: df_real_sample[c].to_numpy() for c in plot_vars}
+        fake = {c: df_fake_sample[c].to_numpy() for c in plot_vars}
         fig3 = plt.figure(figsize=(len(x_vars) * figsize, len(y_vars) * figsize))
         s3 = [fig3.add_subplot(len(y_vars), len(x_vars), i + 1) for i in range(len(x_vars) * len(y_vars))]
         for y in y_vars:
             for x in x_vars:
                 s = s3.pop(0)
-                x_real, y_real = df_real_sample[x].to_numpy(),  df_real_sample[y].to_numpy()
-                x_fake, y_fake = df_fake_sample[x].to_numpy(), df_fake_sample[y].to_numpy()
+                x_real, y_real = real[x], real[y]
+                x_fake, y_fake = fake[x], fake[y]
                 from math import sqrt,pi
                 def fit(xx, yy):
                     xx, yy = torch.tensor(xx).to(torch.float), torch.tensor(yy).to(torch.float)